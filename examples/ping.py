@@ -3,39 +3,53 @@ import sys
 import mtrpacket
 
 
+#  uvloop provides a faster drop-in replacement for asyncio's event loop.
+#  Run with it when it is available, but fall back to asyncio's event loop
+#  otherwise, as uvloop isn't available on all platforms.
+try:
+    from uvloop import run as run_loop
+except ImportError:
+    from asyncio import run as run_loop
+
+
 #
 #  We send the probe in a coroutine since mtrpacket operates
 #  asynchronously.  In a more complicated program, this
 #  allows other asynchronous operations to occur concurrently
 #  with the probe.
 #
-async def probe(host):
-    async with mtrpacket.MtrPacket() as mtr:
+async def probe(mtr, host):
+    try:
         result = await mtr.probe(host)
+    except mtrpacket.HostResolveError:
+        print("Can't resolve host '{}'".format(host))
+        return
+
+    #  If the ping got a reply, report the IP address and time
+    if result.success:
+        print('{}: reply from {} in {} ms'.format(
+            host, result.responder, result.time_ms))
+    else:
+        print('{}: no reply ({})'.format(host, result.result))
 
-        #  If the ping got a reply, report the IP address and time
-        if result.success:
-            print('reply from {} in {} ms'.format(
-                result.responder, result.time_ms))
-        else:
-            print('no reply ({})'.format(result.result))
+
+#
+#  A single mtr-packet subprocess can have many probes in-flight
+#  at once, so we start it once and probe all hosts concurrently.
+#
+async def probe_all(hosts):
+    async with mtrpacket.MtrPacket() as mtr:
+        await asyncio.gather(*(probe(mtr, host) for host in hosts))
 
 
-#  Get a hostname to ping from the commandline
+#  Get the hostnames to ping from the commandline
 if len(sys.argv) > 1:
-    hostname = sys.argv[1]
+    hostnames = sys.argv[1:]
 else:
-    print('Usage: python3 ping.py <hostname>')
+    print('Usage: python3 ping.py <hostname> [<hostname> ...]')
     sys.exit(1)
 
 
-#  We need asyncio's event loop to run the coroutine
-loop = asyncio.get_event_loop()
-try:
-    probe_coroutine = probe(hostname)
-    try:
-        loop.run_until_complete(probe_coroutine)
-    except mtrpacket.HostResolveError:
-        print("Can't resolve host '{}'".format(hostname))
-finally:
-    loop.close()
+#  run_loop creates an event loop, runs the coroutine to completion
+#  and closes the loop afterward
+run_loop(probe_all(hostnames))
@@ -5,6 +5,13 @@ import sys
 import mtrpacket
 
 
+#  As in ping.py, prefer uvloop's event loop when it is installed
+try:
+    from uvloop import run as run_loop
+except ImportError:
+    from asyncio import run as run_loop
+
+
 #
 #  ProbeRecord keeps a record of round-trip times of probes and repsonder
 #  IP addresses, for a particular time-to-live (TTL) value.
@@ -16,75 +23,207 @@ class ProbeRecord:
     def __init__(self, ttl):
         self.ttl = ttl
         self.success = False
-        self.ip_addrs = []
+        #  IP addresses are dictionary keys, with None values,
+        #  so that a dictionary can serve as an insertion-ordered set
+        self.ip_addrs = {}
         self.probe_times = []
 
-    #  Format the information about this line for display
-    def print(self, screen):
+        #  Each probe time is formatted once, when it is added
+        self.probe_time_strs = []
+
+        #  The formatted line for display, which is regenerated
+        #  only after a new probe time or IP address is added
+        self.cached_line = None
+
+    #  Record the round-trip time of a probe, or None if it was lost
+    def add_probe_time(self, time):
+        self.probe_times.append(time)
+
+        if time is None:
+            self.probe_time_strs.append('          *')
+        else:
+            self.probe_time_strs.append('  {:>7.3f}ms'.format(time))
+
+        self.cached_line = None
+
+    #  If the address of the responder isn't already in the list
+    #  of addresses responding at this TTL, add it
+    def add_ip_addr(self, addr):
+        if addr not in self.ip_addrs:
+            self.ip_addrs[addr] = None
+            self.cached_line = None
+
+    #  The number of screen lines used to display this record
+    def line_count(self):
+        return max(len(self.ip_addrs), 1)
+
+    #  Format the information about this record as a line of text
+    def format_line(self):
         line = '{:>2}. '.format(self.ttl)
 
         if self.ip_addrs:
-            line += '{:42}'.format(self.ip_addrs[0])
+            line += '{:42}'.format(next(iter(self.ip_addrs)))
         else:
             line += '{:42}'.format('  ???')
 
-        for time in self.probe_times:
-            if time is None:
-                line += '          *'
-            else:
-                line += '  {:>7.3f}ms'.format(time)
+        line += ''.join(self.probe_time_strs)
 
-        #  Use curses to display the line
-        screen.addstr(line + '\n')
+        return line
 
-        #  List IP addresses beyond the first
-        for addr in self.ip_addrs[1:]:
-            screen.addstr('    ' + addr + '\n')
+    #  Display the information about this record,
+    #  starting at a particular row of the screen
+    def print(self, screen, row):
+        if self.cached_line is None:
+            self.cached_line = self.format_line()
+        line = self.cached_line
 
+        #  Use curses to display the line, replacing what was there
+        screen.move(row, 0)
+        screen.clrtoeol()
+        screen.addstr(line)
 
-#  When we've got a result for one of our probes, we'll regenerate
-#  the screen output, and allow curses to refresh it.
-def redraw(screen, hostname, all_records):
-    screen.erase()
+        #  List IP addresses beyond the first
+        for addr in list(self.ip_addrs)[1:]:
+            row += 1
+            screen.move(row, 0)
+            screen.clrtoeol()
+            screen.addstr('    ' + addr)
 
-    screen.addstr('Tracing to "{}"\n\n'.format(hostname))
 
-    for record in all_records:
-        record.print(screen)
+#
+#  TraceDisplay tracks what is currently on the screen, so that when
+#  we've got a result for one of our probes, only the lines for that
+#  probe's record need to be redrawn, and curses only needs to send
+#  the changed characters to the terminal.
+#
+#  Many probes may complete at nearly the same time, so rather than
+#  updating the terminal for each, records are marked as dirty and
+#  the screen is updated for all of them at once, at most sixty
+#  times per second.
+#
+#  Because the screen is updated from an event loop callback rather
+#  than from a task, an exception raised while drawing is stored in
+#  the 'failure' future, to be raised by the task running the trace.
+#
+class TraceDisplay:
+    def __init__(self, screen, hostname, all_records):
+        self.screen = screen
+        self.hostname = hostname
+        self.all_records = all_records
+        self.layout = None
+        self.dirty_records = set()
+        self.flush_handle = None
+        self.failure = asyncio.get_event_loop().create_future()
+
+    #  Compute the starting row of each record to be displayed
+    def compute_layout(self):
+        layout = []
+        row = 2
+
+        for record in self.all_records:
+            layout.append((record.ttl, row))
+            row += record.line_count()
+
+            #  If one of our probes has arrived at the destination IP,
+            #  we don't need to display further hops
+            if record.success:
+                break
+
+        return layout
+
+    #  Regenerate the entire screen output
+    def draw_all(self, layout):
+        self.screen.erase()
+
+        self.screen.addstr(0, 0, 'Tracing to "{}"'.format(self.hostname))
+
+        for (ttl, row) in layout:
+            self.all_records[ttl - 1].print(self.screen, row)
+
+        #  The footer follows the last record displayed, after a blank line
+        (last_ttl, last_row) = layout[-1]
+        footer_row = last_row + self.all_records[last_ttl - 1].line_count() + 1
+        self.screen.addstr(footer_row, 0, '(press SPACEBAR to exit)')
+
+        self.layout = layout
+
+    #  Note that a record has a new probe result, and schedule
+    #  an update of the screen, if one isn't already pending
+    def mark_dirty(self, record):
+        self.dirty_records.add(record)
+
+        if not self.flush_handle and not self.failure.done():
+            loop = asyncio.get_event_loop()
+            self.flush_handle = loop.call_later(0.016, self.flush)
+
+    #  Draw any pending update of the screen immediately, rather than
+    #  waiting for it to be scheduled, and raise any exception which
+    #  occurred while drawing
+    def finish(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush()
+
+        if self.failure.done():
+            self.failure.result()
+
+    #  Discard any pending update of the screen
+    def cancel(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+    #  The scheduled update of the screen, storing any exception
+    #  raised while drawing, rather than leaving it to the event loop
+    def flush(self):
+        self.flush_handle = None
 
-        #  If one of our probes has arrived at the destination IP,
-        #  we don't need to display further hops
-        if record.success:
-            break
+        try:
+            self.draw_dirty()
+        except Exception as exc:
+            self.failure.set_exception(exc)
+
+    #  Update the screen for all records with new probe results.
+    #  If a record has changed the positions of other records,
+    #  (by adding a new IP address, or by reaching the destination)
+    #  we need to draw everything again.
+    def draw_dirty(self):
+        layout = self.compute_layout()
+
+        if layout != self.layout:
+            self.draw_all(layout)
+        else:
+            rows = dict(layout)
+            for record in self.dirty_records:
+                row = rows.get(record.ttl)
+                if row is not None:
+                    record.print(self.screen, row)
 
-    screen.addstr('\n(press SPACEBAR to exit)\n')
+        self.dirty_records.clear()
 
-    screen.refresh()
+        self.screen.noutrefresh()
+        curses.doupdate()
 
 
-#  Perform multiple probes with a specific time to live (TTL) value
-async def probe_ttl(mtr, hostname, ttl, record, redraw_callback):
-    for count in range(3):
-        result = await mtr.probe(hostname, ttl=ttl, timeout=1)
+#  Perform multiple probes with a specific time to live (TTL) value.
+#  All probes for the TTL are issued together, so that mtr-packet
+#  can have them in-flight simultaneously.
+async def probe_ttl(mtr, hostname, ttl, record, mark_dirty):
+    results = await asyncio.gather(
+        *(mtr.probe(hostname, ttl=ttl, timeout=1) for _ in range(3)))
 
+    for result in results:
         if result.success:
             record.success = True
 
-        #  Record the time of the latest probe
-        record.probe_times.append(result.time_ms)
-
-        addr = result.responder
-        #  If the address of the responder isn't already in the list
-        #  of addresses responding at this TTL, add it
-        if addr and addr not in record.ip_addrs:
-            record.ip_addrs.append(addr)
+        #  Record the time of the probe
+        record.add_probe_time(result.time_ms)
 
-        #  Redraw the display, which will include this probe
-        redraw_callback()
+        if result.responder:
+            record.add_ip_addr(result.responder)
 
-        #  Wait a small amount of time before sending the next probe
-        #  to get an independent sample of network conditions
-        await asyncio.sleep(0.1)
+    #  Update the display, which will include these probes
+    mark_dirty(record)
 
 
 #  Launch all the probes for the trace.
@@ -94,12 +233,12 @@ async def launch_probes(screen, hostname):
     all_records = []
 
     #  When one of the probes has a result to display, we'll use
-    #  this callback to display it
-    def redraw_hops():
-        redraw(screen, hostname, all_records)
+    #  the display's mark_dirty method as a callback to display it
+    display = TraceDisplay(screen, hostname, all_records)
 
     async with mtrpacket.MtrPacket() as mtr:
         probe_tasks = []
+        probes = None
 
         try:
             for ttl in range(1, 32):
@@ -108,21 +247,38 @@ async def launch_probes(screen, hostname):
                 all_records.append(record)
 
                 #  Start a new asyncio task for this probe
-                probe_coro = probe_ttl(mtr, hostname, ttl, record, redraw_hops)
+                probe_coro = probe_ttl(
+                    mtr, hostname, ttl, record, display.mark_dirty)
                 probe_tasks.append(asyncio.ensure_future(probe_coro))
 
-                #  Give each probe a slight delay to avoid flooding
-                #  the network interface, which might perturb the
-                #  results
-                await asyncio.sleep(0.05)
+            #  Wait for all the probes, which were launched together,
+            #  unless updating the display fails first
+            probes = asyncio.gather(*probe_tasks)
+            await asyncio.wait(
+                [probes, display.failure],
+                return_when=asyncio.FIRST_COMPLETED)
 
-            await asyncio.gather(*probe_tasks)
+            if display.failure.done():
+                display.failure.result()
+            await probes
+
+            #  Draw the results of the last probes, which may still
+            #  be waiting for a scheduled update
+            display.finish()
         finally:
-            #  We may have been cancelled, so we should cancel
-            #  the probe tasks we started to clean up
+            #  We may have been cancelled, or drawing may have failed,
+            #  so we should cancel the display updates and the probe
+            #  tasks we started to clean up
+            display.cancel()
+
             for task in probe_tasks:
                 task.cancel()
 
+            #  Wait for the cancelled probes, retrieving their result,
+            #  so that asyncio doesn't report it as never retrieved
+            if probes:
+                await asyncio.gather(probes, return_exceptions=True)
+
 
 #  Wait until a SPACE character to be read on stdin.
 #  Afterward, cancel the probe task so we can exit
@@ -146,39 +302,39 @@ async def wait_for_spacebar(probe_task):
 
 
 #  The main asynchronous routine, running within the asyncio event loop
-async def main_task(hostname):
-    screen = curses.initscr()
-    try:
-        probe_task = asyncio.ensure_future(launch_probes(screen, hostname))
-        spacebar_task = asyncio.ensure_future(wait_for_spacebar(probe_task))
+async def main_task(screen, hostname):
+    probe_task = asyncio.ensure_future(launch_probes(screen, hostname))
+    spacebar_task = asyncio.ensure_future(wait_for_spacebar(probe_task))
 
-        try:
-            await asyncio.gather(probe_task, spacebar_task)
-        except asyncio.CancelledError:
-            #  It is normal for probe_task to be cancelled by
-            #  the spacebar task
-            pass
-        finally:
-            #  We need to clean up by cancelling if gather has returned
-            #  early, perhaps due to an exception raised in one of
-            #  our tasks.
-            probe_task.cancel()
-            spacebar_task.cancel()
+    try:
+        await asyncio.gather(probe_task, spacebar_task)
+    except asyncio.CancelledError:
+        #  It is normal for probe_task to be cancelled by
+        #  the spacebar task
+        pass
     finally:
-        curses.endwin()
+        #  We need to clean up by cancelling if gather has returned
+        #  early, perhaps due to an exception raised in one of
+        #  our tasks.
+        probe_task.cancel()
+        spacebar_task.cancel()
+
+
+#  Run the asyncio event loop with an initialized curses screen
+def run_event_loop(screen, hostname):
+    run_loop(main_task(screen, hostname))
 
 
 #  Use asyncio's event loop for the main body of our program.
 #  We want to use curses for displaying results throughout our
 #  execution, so we'll wrap the event loop with curses initialization.
+#  curses.wrapper restores the terminal when we exit, even if an
+#  exception is raised.
 def main(hostname):
-    loop = asyncio.get_event_loop()
     try:
-        loop.run_until_complete(main_task(hostname))
+        curses.wrapper(run_event_loop, hostname)
     except mtrpacket.HostResolveError:
         print("Can't resolve host '{}'".format(hostname))
-    finally:
-        loop.close()
 
 
 #  Get the hostname to trace to on the commandline
@@ -1,56 +1,128 @@
-import asyncio
 import sys
 import mtrpacket
 
 
+#  Use uvloop to run the event loop, if it is installed.  (See ping.py)
+try:
+    from uvloop import run as run_loop
+except ImportError:
+    from asyncio import run as run_loop
+
+
+#
+#  TraceStats accumulates the results of probes with a particular
+#  time-to-live (TTL) value, across multiple cycles of the trace.
+#
+class TraceStats:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.sent = 0
+        self.times = []
+
+        #  IP addresses are dictionary keys, with None values,
+        #  so that a dictionary can serve as an insertion-ordered set
+        self.responders = {}
+
+    #  Record the result of one probe
+    def add_result(self, result):
+        self.sent += 1
+
+        if result.time_ms is not None:
+            self.times.append(result.time_ms)
+
+        if result.responder:
+            self.responders[result.responder] = None
+
+    #  Format the accumulated results as a line of the summary table
+    def format_line(self):
+        responder = next(iter(self.responders), '???')
+        loss = 100.0 * (self.sent - len(self.times)) / self.sent
+
+        line = '{:>3}. {:40} {:>5.1f}%'.format(self.ttl, responder, loss)
+        if self.times:
+            line += ' {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                min(self.times),
+                sum(self.times) / len(self.times),
+                max(self.times))
+
+        return line
+
+
 #
 #  Coroutine which sends probes for each network hop.
 #  In this case, we wait for each probe to complete before
 #  sending the next, but a more complicated program could
 #  issue multiple probes concurrently.
 #
-async def trace(host):
+#  The trace is repeated for the requested number of cycles,
+#  using the same mtr-packet subprocess for every cycle.
+#
+async def trace(host, count):
+    all_stats = []
+
     async with mtrpacket.MtrPacket() as mtr:
+        for cycle in range(count):
+
+            #
+            #  The time-to-live (TTL) value of the probe determines
+            #  the number of network hops the probe will take
+            #  before its status is reported
+            #
+            for ttl in range(1, 256):
+                result = await mtr.probe(host, ttl=ttl)
+
+                if len(all_stats) < ttl:
+                    all_stats.append(TraceStats(ttl))
+                all_stats[ttl - 1].add_result(result)
+
+                #  Format the probe results for printing
+                line = '{}.'.format(ttl)
+                if result.time_ms:
+                    line += ' {}ms'.format(result.time_ms)
+                line += ' {}'.format(result.result)
+                if result.responder:
+                    line += ' from {}'.format(result.responder)
+
+                print(line)
+
+                #  If a probe arrived at its destination IP address,
+                #  there is no need for further probing.
+                if result.success:
+                    break
+
+    #  Summarize the results of all cycles
+    if count > 1:
+        print()
+        print('{:>3}  {:40} {:>6} {:>9} {:>9} {:>9}'.format(
+            'TTL', 'Host', 'Loss', 'Min ms', 'Avg ms', 'Max ms'))
+        for stats in all_stats:
+            print(stats.format_line())
+
+
+#  Get a hostname to trace to, and optionally a count of trace cycles,
+#  on the commandline
+args = sys.argv[1:]
+cycle_count = 1
+usage_ok = True
+
+if args and args[0] == '-c':
+    if len(args) > 1 and args[1].isdigit():
+        cycle_count = int(args[1])
+    else:
+        usage_ok = False
+    args = args[2:]
 
-        #
-        #  The time-to-live (TTL) value of the probe determines
-        #  the number of network hops the probe will take
-        #  before its status is reported
-        #
-        for ttl in range(1, 256):
-            result = await mtr.probe(host, ttl=ttl)
-
-            #  Format the probe results for printing
-            line = '{}.'.format(ttl)
-            if result.time_ms:
-                line += ' {}ms'.format(result.time_ms)
-            line += ' {}'.format(result.result)
-            if result.responder:
-                line += ' from {}'.format(result.responder)
-
-            print(line)
-
-            #  If a probe arrived at its destination IP address,
-            #  there is no need for further probing.
-            if result.success:
-                break
-
-
-#  Get a hostname to trace to on the commandline
-if len(sys.argv) > 1:
-    hostname = sys.argv[1]
+if usage_ok and cycle_count > 0 and len(args) == 1 \
+        and not args[0].startswith('-'):
+    hostname = args[0]
 else:
-    print('Usage: python3 trace-sequential.py <hostname>')
+    print('Usage: python3 trace-sequential.py [-c COUNT] <hostname>')
     sys.exit(1)
 
 
-#  We need asyncio's event loop to run the coroutine
-loop = asyncio.get_event_loop()
+#  run_loop creates an event loop, runs the coroutine to completion
+#  and closes the loop afterward
 try:
-    trace_coroutine = trace(hostname)
-    try:
-        loop.run_until_complete(trace_coroutine)
-    except mtrpacket.HostResolveError:
-        print("Can't resolve host '{}'".format(hostname))
-finally:
-    loop.close()
+    run_loop(trace(hostname, cycle_count))
+except mtrpacket.HostResolveError:
+    print("Can't resolve host '{}'".format(hostname))
@@ -100,7 +100,29 @@ from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 #  in-flight, we will cache IP addresses for hostnames for
 #  an MtrPacket session.
 #
-DnsCacheType = Dict[Tuple[str, Optional[int]], Tuple[str, int]]
+#  The cache holds the task resolving the address, so that
+#  many probes sent to the same host at the same time share
+#  a single lookup, rather than each resolving the hostname.
+#
+DnsCacheType = Dict[
+    Tuple[str, Optional[int]], 'asyncio.Future[Tuple[str, int]]']
+
+
+#
+#  The maximum number of bytes to read from the stdout of the
+#  mtr-packet subprocess at once.  When many probes are in-flight,
+#  multiple results may be read and dispatched with a single read.
+#
+_READ_SIZE = 64 * 1024
+
+
+#
+#  The amount of unread output from the mtr-packet subprocess which
+#  may accumulate before asyncio stops reading from the pipe.
+#  This is larger than asyncio's default, so that large bursts of
+#  results can be read without pausing and resuming the pipe.
+#
+_READ_BUFFER_LIMIT = 1024 * 1024
 
 
 class MtrPacket:
@@ -127,6 +149,8 @@ class MtrPacket:
         self._result_task = None
         self._next_command_token = 1
         self._dns_cache = {}
+        self._command_buffer = bytearray()
+        self._flush_handle = None
 
         if not mtr_packet_command:
             mtr_packet_command = os.environ.get('MTR_PACKET')
@@ -186,9 +210,18 @@ class MtrPacket:
         """
 
         try:
+            #  Read as much as is available, and dispatch each complete
+            #  line, saving any partial line until more is read
+            partial = b''
             while not self.process.stdout.at_eof():
-                line = await self.process.stdout.readline()
-                self._dispatch_result_line(line.decode('ascii'))
+                data = await self.process.stdout.read(_READ_SIZE)
+
+                (lines, partial) = _split_result_lines(partial, data)
+                for line in lines:
+                    self._dispatch_result_line(line)
+
+            if partial:
+                self._dispatch_result_line(partial.decode('ascii'))
         finally:
             exc_description = \
                 'failure to communicate with subprocess "{}"'.format(
@@ -282,9 +315,28 @@ class MtrPacket:
             command_str += ' ' + argument_name + ' ' + argument_value
         command_str += '\n'
 
-        self.process.stdin.write(command_str.encode('ascii'))
+        self._command_buffer += command_str.encode('ascii')
+        if not self._flush_handle:
+            self._flush_handle = asyncio.get_event_loop().call_soon(
+                self._flush_commands)
+
         return await future
 
+    def _flush_commands(self) -> None:
+
+        """Write all buffered commands to the mtr-packet subprocess
+
+        Commands issued while the event loop is running other tasks
+        are buffered, and written to stdin of the subprocess together
+        with a single write.
+        """
+
+        self._flush_handle = None
+
+        if self.process and self._command_buffer:
+            self.process.stdin.write(bytes(self._command_buffer))
+        self._command_buffer.clear()
+
     async def open(self) -> 'MtrPacket':
 
         """Launch an mtr-packet subprocess to accept commands
@@ -310,14 +362,22 @@ class MtrPacket:
         self.process = await asyncio.create_subprocess_shell(
             self._subprocess_command,
             stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE)
+            stdout=asyncio.subprocess.PIPE,
+            limit=_READ_BUFFER_LIMIT)
 
         self._result_task = asyncio.ensure_future(self._dispatch_results())
         self._opened = True
 
-        if not await self.check_support('send-probe'):
-            await self.close()
+        #  Close the subprocess if it lacks probe support, or if
+        #  checking for support fails, so the process is reaped
+        supported = False
+        try:
+            supported = await self.check_support('send-probe')
+        finally:
+            if not supported:
+                await self.close()
 
+        if not supported:
             raise ProcessError('subprocess missing probe support')
 
         return self
@@ -334,6 +394,16 @@ class MtrPacket:
 
         self._opened = False
 
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._command_buffer.clear()
+
+        #  Cancel hostname lookups still in progress.  Cancelled lookups
+        #  are removed from the DNS cache when they complete.
+        for lookup in list(self._dns_cache.values()):
+            lookup.cancel()
+
         if self._result_task:
             self._result_task.cancel()
             self._result_task = None
@@ -436,7 +506,8 @@ class MtrPacket:
         Raises HostResolveError if the hostname can't be resolved to
         an IP address.
 
-        Raises StateError if the MtrPacket session hasn't been opened.
+        Raises StateError if the MtrPacket session hasn't been opened,
+        or is closed while the hostname is being resolved.
         """
 
         pack = await _package_args(self._dns_cache, host, args)
@@ -461,6 +532,25 @@ class MtrPacket:
         self._dns_cache = {}
 
 
+def _split_result_lines(
+        partial: bytes,
+        data: bytes
+) -> Tuple[List[str], bytes]:
+
+    """Split output read from mtr-packet into complete lines
+
+    Output is read in chunks, which may end in the middle of a line.
+    Given the partial line left over from the previous chunk and
+    newly read data, return the complete lines, and the partial line
+    to be prepended to the next chunk.
+    """
+
+    lines = (partial + data).split(b'\n')
+    partial = lines.pop()
+
+    return ([line.decode('ascii') for line in lines], partial)
+
+
 async def _resolve_ip(
         dns_cache: DnsCacheType,
         host: str,
@@ -472,11 +562,48 @@ async def _resolve_ip(
     Resolve a hostname prior to sending a network probe.  An optional
     IP version parameter can be used to require either an IPv4 or
     IPv6 address.
+
+    Concurrent requests for the same hostname wait on the same lookup.
+    Failed lookups are removed from the cache, so that they can be
+    retried by later probes.
     """
 
     cache_key = (host, target_ip_version)
-    if cache_key in dns_cache:
-        return dns_cache[cache_key]
+    lookup = dns_cache.get(cache_key)
+
+    if lookup is None:
+        lookup = asyncio.ensure_future(_lookup_ip(host, target_ip_version))
+        dns_cache[cache_key] = lookup
+
+        def forget_failure(
+                lookup: 'asyncio.Future[Tuple[str, int]]') -> None:
+            if lookup.cancelled() or lookup.exception():
+                if dns_cache.get(cache_key) is lookup:
+                    del dns_cache[cache_key]
+
+        lookup.add_done_callback(forget_failure)
+
+    #  Shield the shared lookup, so that cancelling one probe
+    #  doesn't cancel the lookup for other probes to the same host
+    try:
+        return await asyncio.shield(lookup)
+    except asyncio.CancelledError:
+        #  The lookup itself is only cancelled by closing the session
+        if lookup.cancelled():
+            raise StateError('closed while resolving host')
+        raise
+
+
+async def _lookup_ip(
+        host: str,
+        target_ip_version: Optional[int]
+) -> Tuple[str, int]:
+
+    """Look up the IP address of a hostname using the event loop
+
+    Returns the first address of the requested IP version, or of
+    either version if no version is specified.
+    """
 
     try:
         addrinfo = await asyncio.get_event_loop().getaddrinfo(host, 0)
@@ -488,15 +615,11 @@ async def _resolve_ip(
 
         if family == socket.AF_INET:
             if not target_ip_version or target_ip_version == 4:
-                dns_addr = (addr[0], 4)
-                dns_cache[cache_key] = dns_addr
-                return dns_addr
+                return (addr[0], 4)
 
         if family == socket.AF_INET6:
             if not target_ip_version or target_ip_version == 6:
-                dns_addr = (addr[0], 6)
-                dns_cache[cache_key] = dns_addr
-                return dns_addr
+                return (addr[0], 6)
 
     raise HostResolveError("Unable to resolve '{}'".format(host))
 
@@ -625,16 +748,17 @@ def _make_probe_result(
     mpls = []
     mpls_arg = args.get('mpls')
     if mpls_arg:
-        mpls_values = list(map(int, mpls_arg.split(',')))
+        mpls_values = map(int, mpls_arg.split(','))
 
-        while len(mpls_values) >= 4:
+        #  Each group of four values is one label in the stack.
+        #  Zipping the same iterator four times groups the values.
+        for (label, traffic_class, bottom_of_stack, ttl) in zip(
+                *[mpls_values] * 4):
             mpls.append(Mpls(
-                mpls_values[0],
-                mpls_values[1],
-                bool(mpls_values[2]),
-                mpls_values[3]))
-
-            mpls_values = mpls_values[4:]
+                label,
+                traffic_class,
+                bool(bottom_of_stack),
+                ttl))
 
     return ProbeResult(success, command_result, time_ms, responder, mpls)
 
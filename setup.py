@@ -14,6 +14,9 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/matt-kimball/mtr-packet-python",
     packages=setuptools.find_packages(),
+    extras_require={
+        "uvloop": ['uvloop>=0.18; platform_system != "Windows"'],
+    },
     classifiers=[
         "Topic :: System :: Networking",
         "Framework :: AsyncIO",
@@ -1,7 +1,9 @@
 import asyncio
 import collections
 import os
+import socket
 import unittest
+import unittest.mock
 
 import mtrpacket
 
@@ -13,45 +15,85 @@ def make_command(line):
 
     """Convert a command string into a Command named type"""
 
-    atoms = line.decode('ascii').strip().split(' ')
+    (token, command, *atoms) = line.decode('ascii').split()
 
-    token = atoms[0]
-    command = atoms[1]
-    args = {}
-
-    i = 2
-    while i + 1 < len(atoms):
-        args[atoms[i]] = atoms[i + 1]
-        i += 2
+    #  Pair each argument name with the value following it
+    atom_iter = iter(atoms)
+    args = dict(zip(atom_iter, atom_iter))
 
     return Command(token, command, args)
 
 
-class MtrPacketSubstitute:
+def encode_reply(token, reply_body):
+
+    """Encode a command reply line, as mtr-packet would write it"""
+
+    return token.encode('ascii') + b' ' + reply_body + b'\n'
+
+
+def encode_target_reply(command):
+
+    """Encode a reply to a probe, as if from the probe's target"""
 
-    """Substitute the 'mtr-packet' executable with an alternative
+    reply_body = (
+        b'reply ip-4 ' + command.args['ip-4'].encode('ascii') +
+        b' round-trip-time 1000')
+    return encode_reply(command.token, reply_body)
 
-    To be used in a 'with' code block to provide an altnerative
-    to 'mtr-packet' for mtrpacket.MtrPacket objects used in that block.
+
+def gen_mock_mtr_packet(respond):
+
+    """Generate a connection handler substituting for mtr-packet
+
+    Commands are read from the connection.  'check-support' commands
+    are always answered as supported.  Other commands are passed to
+    respond, which returns the encoded reply lines to be written, if
+    any.  (See encode_reply)
     """
 
-    def __init__(self, substitute):
-        self.substitute = substitute
-        self.saved = None
+    async def handle_command(reader, writer):
+        while not reader.at_eof():
+            line = await reader.readline()
 
-    def __enter__(self):
-        try:
-            self.saved = os.environ['MTR_PACKET']
-        except KeyError:
-            self.saved = None
+            if line:
+                command = make_command(line)
+
+                if command.command == 'check-support':
+                    reply = encode_reply(
+                        command.token, b'feature-support support ok')
+                else:
+                    reply = respond(command)
+
+                if reply:
+                    writer.write(reply)
 
-        os.environ['MTR_PACKET'] = self.substitute
+        writer.close()
 
-    def __exit__(self, etype, evalue, traceback):
-        if self.saved:
-            os.environ['MTR_PACKET'] = self.saved
-        else:
-            del os.environ['MTR_PACKET']
+    return handle_command
+
+
+class EventQueue:
+
+    """A lightweight queue for a single producer and a single consumer
+
+    Items are held in a deque, with an asyncio.Event used to wake
+    the consumer when an item is added.
+    """
+
+    def __init__(self):
+        self.items = collections.deque()
+        self.event = asyncio.Event()
+
+    def put_nowait(self, item):
+        self.items.append(item)
+        self.event.set()
+
+    async def get(self):
+        while not self.items:
+            await self.event.wait()
+            self.event.clear()
+
+        return self.items.popleft()
 
 
 class TestProcExit(unittest.TestCase):
@@ -59,13 +101,12 @@ class TestProcExit(unittest.TestCase):
     """Test behavior when the mtr-packet subprocess unexpectedly exits"""
 
     async def async_proc_exit(self):
-        async with mtrpacket.MtrPacket() as mtr:
+        async with mtrpacket.MtrPacket('true') as mtr:
             await mtr.probe('127.0.0.1')
 
     def test_proc_exit(self):
-        with MtrPacketSubstitute('true'):
-            with self.assertRaises(mtrpacket.ProcessError):
-                asyncio_run(self.async_proc_exit())
+        with self.assertRaises(mtrpacket.ProcessError):
+            asyncio_run(self.async_proc_exit())
 
 
 class TestMissingExecutable(unittest.TestCase):
@@ -77,7 +118,9 @@ class TestMissingExecutable(unittest.TestCase):
             pass
 
     def test_missing_exec(self):
-        with MtrPacketSubstitute('mtr-packet-missing'):
+        #  Substitute through the environment, to exercise MTR_PACKET
+        substitute = {'MTR_PACKET': 'mtr-packet-missing'}
+        with unittest.mock.patch.dict(os.environ, substitute):
             with self.assertRaises(mtrpacket.ProcessError):
                 asyncio_run(self.async_missing_exec())
 
@@ -98,9 +141,21 @@ class TestCancellation(unittest.TestCase):
 
     async def async_launch(self):
         async with mtrpacket.MtrPacket() as mtr:
-            coro = self.command_wait(mtr)
-            task = asyncio.ensure_future(coro)
-            await asyncio.sleep(1)
+            #  Note when the probe command is written to the subprocess,
+            #  at which point the task is waiting on the probe result
+            probe_sent = asyncio.Event()
+            stdin_write = mtr.process.stdin.write
+
+            def write_and_notify(data):
+                stdin_write(data)
+                probe_sent.set()
+
+            with unittest.mock.patch.object(
+                    mtr.process.stdin, 'write', write_and_notify):
+                coro = self.command_wait(mtr)
+                task = asyncio.ensure_future(coro)
+                await probe_sent.wait()
+
             task.cancel()
             try:
                 await task
@@ -121,121 +176,281 @@ class TestCommands(unittest.TestCase):
     responses as if we were the 'mtr-packet' subprocess.
     """
 
-    def gen_handle_command(self, in_queue, out_queue):
-        async def handle_command(reader, writer):
-            while not reader.at_eof():
-                line = await reader.readline()
-
-                if line:
-                    command = make_command(line)
-
-                    if command.command == 'check-support':
-                        reply = command.token + ' feature-support support ok\n'
-                    else:
-                        #  Save received commands to in_queue
-                        in_queue.put_nowait(command)
-
-                        #  Respond with a canned response from out_queue
-                        reply_body = await out_queue.get()
-                        reply = command.token + ' ' + reply_body + '\n'
-
-                    writer.write(reply.encode('ascii'))
-
-            writer.close()
-
-        return handle_command
-
-    async def send_probes(self, mtr, in_queue, out_queue):
-        out_queue.put_nowait('reply ip-4 8.8.4.4 round-trip-time 1000')
-        result = await mtr.probe('8.8.8.8', bit_pattern=42)
-        command = await in_queue.get()
-
-        assert command.command == 'send-probe'
-        assert command.args['ip-4'] == '8.8.8.8'
+    #  The label stack expected from 'mpls 1,2,0,3,4,5,1,6'
+    expected_mpls = [
+        mtrpacket.Mpls(1, 2, False, 3),
+        mtrpacket.Mpls(4, 5, True, 6),
+    ]
+
+    #  Canned, already encoded, responses for each probe, keyed by
+    #  the probe's target address and TTL.  The probes are sent
+    #  concurrently, so the commands may arrive in any order.
+    replies = {
+        ('8.8.8.8', None): b'reply ip-4 8.8.4.4 round-trip-time 1000',
+        ('127.0.1.1', None): b'reply ip-4 127.0.1.1 round-trip-time 500',
+        ('::1', '4'): b'no-reply',
+        ('8.8.9.9', None): b'ttl-expired ip-4 8.0.0.1 mpls 1,2,0,3,4,5,1,6',
+        ('127.0.0.1', None): b'reply ip-4 127.0.0.1 round-trip-time 1000',
+        ('::1', None): b'reply ip-6 ::1 round-trip-time 1000',
+    }
+
+    @staticmethod
+    def reply_key(command):
+        address = command.args.get('ip-4') or command.args.get('ip-6')
+        return (address, command.args.get('ttl'))
+
+    def gen_respond(self, in_queue):
+        def respond(command):
+            #  Save received commands to in_queue
+            in_queue.put_nowait(command)
+
+            #  Respond with the canned response for the probe
+            reply_body = self.replies[self.reply_key(command)]
+            return encode_reply(command.token, reply_body)
+
+        return respond
+
+    async def send_probes(self, mtr, in_queue):
+        #  Send all probes at once, so that they are in-flight together
+        results = await asyncio.gather(
+            mtr.probe('8.8.8.8', bit_pattern=42),
+            mtr.probe('127.0.1.1', local_ip='127.0.0.1'),
+            mtr.probe('::1', ttl=4),
+            mtr.probe('8.8.9.9'),
+            mtr.probe('localhost', ip_version=4),
+            mtr.probe('ip6-localhost', ip_version=6))
+
+        commands = {}
+        for _ in results:
+            command = await in_queue.get()
+            assert command.command == 'send-probe'
+            commands[self.reply_key(command)] = command
+
+        assert len(commands) == len(results)
+
+        result = results[0]
+        command = commands[('8.8.8.8', None)]
         assert command.args['bit-pattern'] == '42'
         assert result.success
         assert result.responder == '8.8.4.4'
         assert result.time_ms == 1.0
 
-        out_queue.put_nowait('reply ip-4 127.0.1.1 round-trip-time 500')
-        result = await mtr.probe('127.0.1.1', local_ip='127.0.0.1')
-        command = await in_queue.get()
-
-        assert command.command == 'send-probe'
-        assert command.args['ip-4'] == '127.0.1.1'
+        result = results[1]
+        command = commands[('127.0.1.1', None)]
         assert command.args['local-ip-4'] == '127.0.0.1'
         assert result.success
         assert result.responder == '127.0.1.1'
         assert result.time_ms == 0.5
 
-        out_queue.put_nowait('no-reply')
-        result = await mtr.probe('::1', ttl=4)
-        command = await in_queue.get()
-
-        assert command.command == 'send-probe'
-        assert command.args['ip-6'] == '::1'
-        assert command.args['ttl'] == '4'
+        result = results[2]
+        assert 'ip-6' in commands[('::1', '4')].args
         assert not result.success
         assert result.result == 'no-reply'
 
-        out_queue.put_nowait('ttl-expired ip-4 8.0.0.1 mpls 1,2,0,3,4,5,1,6')
-        result = await mtr.probe('8.8.9.9')
-        command = await in_queue.get()
-
-        assert len(result.mpls) == 2
-        assert result.mpls[0].label == 1
-        assert result.mpls[0].traffic_class == 2
+        result = results[3]
+        assert result.mpls == self.expected_mpls
         assert result.mpls[0].bottom_of_stack is False
-        assert result.mpls[0].ttl == 3
-        assert result.mpls[1].label == 4
-        assert result.mpls[1].traffic_class == 5
         assert result.mpls[1].bottom_of_stack is True
-        assert result.mpls[1].ttl == 6
-
-        out_queue.put_nowait('reply ip-4 127.0.0.1 round-trip-time 1000')
-        result = await mtr.probe('localhost', ip_version=4)
-        command = await in_queue.get()
 
-        assert command.command == 'send-probe'
-        assert 'ip-4' in command.args
+        result = results[4]
+        assert 'ip-4' in commands[('127.0.0.1', None)].args
         assert result.success
         assert result.responder == '127.0.0.1'
         assert result.time_ms == 1.0
 
-        out_queue.put_nowait('reply ip-6 ::1 round-trip-time 1000')
-        result = await mtr.probe('ip6-localhost', ip_version=6)
-        command = await in_queue.get()
-
-        assert command.command == 'send-probe'
-        assert 'ip-6' in command.args
+        result = results[5]
+        assert 'ip-6' in commands[('::1', None)].args
         assert result.success
         assert result.responder == '::1'
         assert result.time_ms == 1.0
 
     async def async_commands(self):
-        in_queue = asyncio.Queue()
-        out_queue = asyncio.Queue()
+        in_queue = EventQueue()
 
         server = await asyncio.start_server(
-            self.gen_handle_command(in_queue, out_queue), '127.0.0.1', 8901)
+            gen_mock_mtr_packet(self.gen_respond(in_queue)),
+            '127.0.0.1', 8901)
 
         try:
-            async with mtrpacket.MtrPacket() as mtr:
-                await self.send_probes(mtr, in_queue, out_queue)
+            async with mtrpacket.MtrPacket('./nc_mock.sh') as mtr:
+                await self.send_probes(mtr, in_queue)
         finally:
             server.close()
 
     def test_commands(self):
-        with MtrPacketSubstitute('./nc_mock.sh'):
-            asyncio_run(self.async_commands())
+        asyncio_run(self.async_commands())
+
+
+class TestReplyFraming(unittest.TestCase):
+
+    """Test results split across reads, or combined in a single read
+
+    Results are read from mtr-packet in chunks, and must be separated
+    into lines regardless of how the output of mtr-packet is divided.
+    Splitting is tested directly, with chosen chunks.  For combined
+    results, as with TestCommands, 'nc' is substituted for 'mtr-packet'
+    so that we control how the results are written.
+    """
+
+    def gen_respond_combined(self, probe_count):
+        commands = []
+
+        #  Respond with a single write, once all probe commands arrive
+        def respond(command):
+            commands.append(command)
+            if len(commands) == probe_count:
+                return b''.join(encode_target_reply(c) for c in commands)
+
+        return respond
+
+    async def send_probes(self, hosts):
+        respond = self.gen_respond_combined(len(hosts))
+        server = await asyncio.start_server(
+            gen_mock_mtr_packet(respond), '127.0.0.1', 8901)
+
+        try:
+            async with mtrpacket.MtrPacket('./nc_mock.sh') as mtr:
+                #  Time out, rather than hang, if a reply is lost
+                probes = asyncio.gather(*(mtr.probe(host) for host in hosts))
+                return await asyncio.wait_for(probes, 5)
+        finally:
+            server.close()
+
+    def test_split_reply(self):
+        split = mtrpacket._split_result_lines
+
+        #  A line split across two reads is held until it is complete
+        (lines, partial) = split(b'', b'1 reply ip-4 8.8.8.8 round-')
+        assert lines == []
+        assert partial == b'1 reply ip-4 8.8.8.8 round-'
+
+        (lines, partial) = split(partial, b'trip-time 1000\n2 no-')
+        assert lines == ['1 reply ip-4 8.8.8.8 round-trip-time 1000']
+        assert partial == b'2 no-'
+
+        (lines, partial) = split(partial, b'reply\n')
+        assert lines == ['2 no-reply']
+        assert partial == b''
+
+    def test_combined_replies(self):
+        hosts = ['8.8.8.8', '8.8.4.4']
+        results = asyncio_run(self.send_probes(hosts))
+
+        for (host, result) in zip(hosts, results):
+            assert result.success
+            assert result.responder == host
+            assert result.time_ms == 1.0
+
+
+class TestDnsCache(unittest.TestCase):
+
+    """Test that probes to one hostname share a single lookup
+
+    The event loop's getaddrinfo is replaced, so that we can count
+    lookups, hold them in progress, and cause them to fail.
+    As with TestCommands, 'nc' is substituted for 'mtr-packet'.
+    """
+
+    def gen_getaddrinfo(self, lookups, release, cancelled_lookups):
+        async def getaddrinfo(host, port, **kwargs):
+            lookups.append(host)
+            try:
+                await release.wait()
+            except asyncio.CancelledError:
+                cancelled_lookups.append(host)
+                raise
+
+            #  The first lookup of 'fail.test' fails, later lookups succeed
+            if host == 'fail.test' and lookups.count(host) == 1:
+                raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+
+            return [(socket.AF_INET, socket.SOCK_RAW, 0, '', ('10.0.0.1', 0))]
+
+        return getaddrinfo
+
+    async def check_lookups(self, mtr, lookups, release, cancelled_lookups):
+        #  Concurrent probes share one lookup
+        release.set()
+        results = await asyncio.gather(
+            *(mtr.probe('shared.test') for _ in range(5)))
+
+        assert lookups.count('shared.test') == 1
+        assert all(result.responder == '10.0.0.1' for result in results)
+
+        #  A failed lookup raises, and is retried by a later probe
+        with self.assertRaises(mtrpacket.HostResolveError):
+            await mtr.probe('fail.test')
+
+        result = await mtr.probe('fail.test')
+
+        assert lookups.count('fail.test') == 2
+        assert result.responder == '10.0.0.1'
+
+        #  Cancelling one probe doesn't cancel the lookup for another
+        release.clear()
+        cancelled_task = asyncio.ensure_future(mtr.probe('cancel.test'))
+        waiting_task = asyncio.ensure_future(mtr.probe('cancel.test'))
+        while 'cancel.test' not in lookups:
+            await asyncio.sleep(0)
+
+        cancelled_task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled_task
+
+        release.set()
+        result = await waiting_task
+
+        assert lookups.count('cancel.test') == 1
+        assert result.responder == '10.0.0.1'
+        assert cancelled_lookups == []
+
+        #  Closing the session cancels lookups still in progress
+        release.clear()
+        closed_task = asyncio.ensure_future(mtr.probe('closed.test'))
+        while 'closed.test' not in lookups:
+            await asyncio.sleep(0)
+
+        await mtr.close()
+        with self.assertRaises(mtrpacket.StateError):
+            await asyncio.wait_for(closed_task, 5)
+
+        assert cancelled_lookups == ['closed.test']
+
+    async def async_dns_cache(self):
+        server = await asyncio.start_server(
+            gen_mock_mtr_packet(encode_target_reply), '127.0.0.1', 8901)
+
+        try:
+            async with mtrpacket.MtrPacket('./nc_mock.sh') as mtr:
+                lookups = []
+                cancelled_lookups = []
+                release = asyncio.Event()
+                getaddrinfo = self.gen_getaddrinfo(
+                    lookups, release, cancelled_lookups)
+
+                with unittest.mock.patch.object(
+                        asyncio.get_event_loop(), 'getaddrinfo', getaddrinfo):
+                    await self.check_lookups(
+                        mtr, lookups, release, cancelled_lookups)
+        finally:
+            server.close()
+
+    def test_dns_cache(self):
+        asyncio_run(self.async_dns_cache())
 
 
 def asyncio_run(coro):
 
-    """Equivalent to Python 3.7's asyncio.run"""
+    """Run a coroutine to completion in a new event loop
+
+    Uses asyncio.run where available (Python 3.7 or newer),
+    falling back to the current event loop for older versions.
+    """
+
+    if hasattr(asyncio, 'run'):
+        return asyncio.run(coro)
 
-    loop = asyncio.get_event_loop()
-    return loop.run_until_complete(loop.create_task(coro))
+    return asyncio.get_event_loop().run_until_complete(coro)
 
 
 unittest.main()